@@ -1,11 +1,15 @@
 import json
 import re
-from collections.abc import Iterable, Iterator, Sequence
-from dataclasses import dataclass
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import cached_property, lru_cache
+from itertools import batched
 from pathlib import Path
 from typing import Any, Protocol, Self, TypedDict
 
 import requests
+from requests.adapters import HTTPAdapter
 
 
 class _AppConfig(Protocol):
@@ -24,22 +28,43 @@ type ParamData = dict[str, ParamDataInner]
 type ParamEncoded = dict[str, ParamAtom]
 
 
-def _encode_inner(data: ParamDataInner) -> Iterator[tuple[Sequence[str], ParamAtom]]:
-    match data:
-        case dict():
-            for key, elem in data.items():
-                for names, encoded in _encode_inner(elem):
-                    yield (key, *names), encoded
-        case list():
-            for i, elem in enumerate(data):
-                for names, encoded in _encode_inner(elem):
-                    yield (str(i), *names), encoded
-        case _:
-            yield (), data
+def _flatten(data: ParamData) -> Iterator[tuple[str, ParamAtom]]:
+    prefix: list[str] = []
+    stack: list[Iterator[tuple[str, ParamDataInner]]] = [iter(data.items())]
+    while stack:
+        item = next(stack[-1], None)
+        if item is None:
+            stack.pop()
+            if prefix:
+                prefix.pop()
+            continue
+        name, elem = item
+        match elem:
+            case dict():
+                prefix.append(name)
+                stack.append(iter(elem.items()))
+            case list():
+                prefix.append(name)
+                stack.append((str(i), value) for i, value in enumerate(elem))
+            case _:
+                key = name
+                if prefix:
+                    key = prefix[0] + "".join(f"[{p}]" for p in prefix[1:]) + f"[{name}]"
+                yield key, elem
 
 
 def encode_params(data: ParamData) -> ParamEncoded:
-    return {names[0] + "".join(f"[{name}]" for name in names[1:]): elem for names, elem in _encode_inner(data)}
+    return dict(_flatten(data))
+
+
+# each grade takes six form fields, stay well below PHP's default max_input_vars of 1000
+_GRADES_PER_REQUEST = 100
+_TUTORIAL_PATTERN = re.compile(r"tut(orium|orial)? (\d+)", flags=re.IGNORECASE)
+
+
+@lru_cache(maxsize=32)
+def _group_pattern(tutorials: frozenset[str]) -> re.Pattern[str]:
+    return re.compile(rf"tut(orium|orial)? ({'|'.join(map(re.escape, sorted(tutorials)))})", flags=re.IGNORECASE)
 
 
 class Group(TypedDict):
@@ -49,11 +74,17 @@ class Group(TypedDict):
 
 
 def _get_submission_files(submission: dict[str, Any]) -> list[dict[str, Any]]:
-    try:
-        file_areas = next(p for p in submission["plugins"] if p["name"] == "File submissions")["fileareas"]
-        return next(a for a in file_areas if a["area"] == "submission_files")["files"]
-    except StopIteration, KeyError:
-        return []
+    plugins = {plugin["name"]: plugin for plugin in submission.get("plugins", [])}
+    file_areas = {area["area"]: area for area in plugins.get("File submissions", {}).get("fileareas", [])}
+    return file_areas.get("submission_files", {}).get("files", [])
+
+
+def _make_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 @dataclass
@@ -61,49 +92,64 @@ class MoodleConnection:
     url: str
     token: str
     course: str
+    session: requests.Session = field(default_factory=_make_session, repr=False, compare=False)
 
     @classmethod
     def from_configs(cls, app: _AppConfig, course: _CourseConfig) -> Self:
         return cls(url=course.moodle_url, token=app.moodle_token, course=course.course_id)
 
     def send(self, function: str, **params: ParamDataInner) -> dict[str, Any]:
-        res = requests.post(
-            f"{self.url}/webservice/rest/server.php?wstoken={self.token}&moodlewsrestformat=json&wsfunction={function}",
-            params=encode_params(params),
+        res = self.session.post(
+            f"{self.url}/webservice/rest/server.php",
+            data={"wstoken": self.token, "moodlewsrestformat": "json", "wsfunction": function, **encode_params(params)},
         )
+        return res.json()
+
+    def _upload_file(self, path: Path, itemid: int | None = None) -> list[dict[str, Any]]:
+        with path.open("rb") as file:
+            res = self.session.post(
+                f"{self.url}/webservice/upload.php",
+                files={path.name: (path.name, file)},
+                params={"token": self.token} | ({"itemid": itemid} if itemid else {}),
+            )
         return json.loads(res.content)
 
     def upload_files(self, paths: Iterable[Path]) -> list[dict[str, Any]]:
         itemid: int | None = None
         response: list[dict[str, Any]] = []
         for path in paths:
-            file_data = path.read_bytes()
-            res = requests.post(
-                f"{self.url}/webservice/upload.php",
-                files={path.name: file_data},
-                params={"token": self.token} | ({"itemid": itemid} if itemid else {}),
-            )
-            res = json.loads(res.content)
+            res = self._upload_file(path, itemid)
             response.extend(res)
             itemid = itemid or res[0]["itemid"]
         return response
 
-    def get_assignments(self) -> list[dict[str, Any]]:
+    def download_file(self, url: str, target: Path) -> None:
+        with self.session.get(url, params={"token": self.token}, stream=True) as res:
+            res.raise_for_status()
+            with target.open("wb") as file:
+                for chunk in res.iter_content(chunk_size=1 << 16):
+                    file.write(chunk)
+
+    @cached_property
+    def _assignments(self) -> list[dict[str, Any]]:
         data = self.send("mod_assign_get_assignments", courseids=[self.course])
         return data["courses"][0]["assignments"]
 
+    def get_assignments(self) -> list[dict[str, Any]]:
+        return self._assignments
+
     def get_assignment(self, assignment_name: str) -> dict[str, Any]:
-        for assignment in self.get_assignments():
-            if assignment["name"].find(assignment_name) >= 0:
-                return assignment
-        raise ValueError
+        assignment = next((a for a in self._assignments if assignment_name in a["name"]), None)
+        if assignment is None:
+            raise ValueError(f"No assignment matching '{assignment_name}' found")
+        return assignment
 
     def get_assignment_submissions(self, assignment_id: int) -> list[dict[str, Any]]:
         data = self.send("mod_assign_get_submissions", assignmentids=[assignment_id])
         return data["assignments"][0]["submissions"]
 
     def get_groups(self, tutorials: list[str]) -> dict[int, str]:
-        pattern = re.compile(rf"tut(orium|orial)? ({'|'.join(tutorials)})", flags=re.IGNORECASE)
+        pattern = _group_pattern(frozenset(tutorials))
         data = self.send("core_group_get_groups_for_selector", courseid=self.course)["groups"]
         parsed: dict[int, str] = {}
         for group in data:
@@ -112,9 +158,13 @@ class MoodleConnection:
         return parsed
 
     def get_submission_files(self, assignment_name: str, tutorials: list[str]) -> dict[str, list[str]]:
-        groups = self.get_groups(tutorials)
-        assignment_id: int = self.get_assignment(assignment_name)["id"]
-        submissions = self.get_assignment_submissions(assignment_id)
+        with ThreadPoolExecutor() as executor:
+            groups_future = executor.submit(self.get_groups, tutorials)
+            submissions_future = executor.submit(
+                lambda: self.get_assignment_submissions(self.get_assignment(assignment_name)["id"])
+            )
+            groups = groups_future.result()
+            submissions = submissions_future.result()
         files: dict[str, list[str]] = {}
         for submission in submissions:
             if submission["groupid"] in groups and submission["status"] == "submitted":
@@ -125,10 +175,9 @@ class MoodleConnection:
 
     def get_grading_data(self, assignment_name: str, groups: Iterable[str]) -> tuple[int, dict[str, list[int]]]:
         assignment_id = self.get_assignment(assignment_name)["id"]
-        pattern = re.compile(r"tut(orium|orial)? (\d+)", flags=re.IGNORECASE)
         tutorials = set()
         for group in groups:
-            found = pattern.search(group)
+            found = _TUTORIAL_PATTERN.search(group)
             if found is not None:
                 tutorials.add(found.group(2))
         users = {}
@@ -141,9 +190,8 @@ class MoodleConnection:
             users[name] = [user["id"] for user in data["users"]]
         return assignment_id, users
 
-    def upload_graded_assignment(self, assignment_id: int, users: list[int], file: Path, points: float) -> None:
-        file_id = self.upload_files([file])[0]["itemid"]
-        grades: ParamDataInner = [
+    def save_grades(self, assignment_id: int, graded: Iterable[tuple[list[int], int, float]]) -> None:
+        grades: list[ParamDataInner] = [
             {
                 "userid": user,
                 "grade": points,
@@ -152,8 +200,14 @@ class MoodleConnection:
                 "workflowstate": "graded",
                 "plugindata": {"files_filemanager": file_id},
             }
+            for users, file_id, points in graded
             for user in users
         ]
-        ret = self.send("mod_assign_save_grades", assignmentid=assignment_id, grades=grades, applytoall=0)
-        if ret:
-            raise RuntimeError("Unexpected error when uploading grades", ret)
+        for batch in batched(grades, _GRADES_PER_REQUEST, strict=False):
+            ret = self.send("mod_assign_save_grades", assignmentid=assignment_id, grades=list(batch), applytoall=0)
+            if ret:
+                raise RuntimeError("Unexpected error when uploading grades", ret)
+
+    def upload_graded_assignment(self, assignment_id: int, users: list[int], file: Path, points: float) -> None:
+        file_id = self.upload_files([file])[0]["itemid"]
+        self.save_grades(assignment_id, [(users, file_id, points)])
@@ -1,12 +1,17 @@
+from functools import lru_cache
 from io import BytesIO
 from logging import getLogger
 from pathlib import Path
+from tempfile import SpooledTemporaryFile
 from typing import TYPE_CHECKING
 
 from pypdf import PdfReader, PdfWriter
+from pypdf.errors import PdfReadError
+from pypdf.generic import NameObject
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import ParagraphStyle
 from reportlab.lib.units import cm
+from reportlab.lib.utils import ImageReader
 from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.pdfgen.canvas import Canvas
 from reportlab.platypus import Paragraph
@@ -15,6 +20,7 @@ if TYPE_CHECKING:
     from reportlab.pdfbase.acroform import AcroForm
 
 getLogger("pypdf").setLevel(50)
+spool_size = 1 << 20
 points_label = "Gesamtpunkte:"
 text = """Korrigiert von {name}<br/>
 Bei Fragen könnt ihr gerne eine mail an <a color="blue" href="mailto:{email}\
@@ -22,7 +28,26 @@ Bei Fragen könnt ihr gerne eine mail an <a color="blue" href="mailto:{email}\
 style = ParagraphStyle("Normal", linkUnderline=True, fontSize=12, leading=15)
 
 
-def draw_grading_page(canvas: Canvas, name: str, email: str, group: str, week: str, image: Path | None) -> None:
+@lru_cache(maxsize=8)
+def load_image(path: Path) -> ImageReader:
+    return ImageReader(path)
+
+
+@lru_cache(maxsize=1)
+def _load_pdf(student_file: Path, mtime_ns: int, size: int) -> PdfReader:
+    return PdfReader(student_file)
+
+
+def _read_pdf(student_file: Path) -> PdfReader:
+    stat = student_file.stat()
+    return _load_pdf(student_file, stat.st_mtime_ns, stat.st_size)
+
+
+def _pdf_version(file: PdfWriter) -> str:
+    return max(file.pdf_header.removeprefix("%PDF-"), file.root_object.get("/Version", "/").removeprefix("/"))
+
+
+def draw_grading_page(canvas: Canvas, name: str, email: str, group: str, week: str, image: ImageReader | None) -> None:
     x, y = 2.5 * cm, 25 * cm
     width, height = 16 * cm, 10 * cm
     canvas.translate(x, y)
@@ -59,25 +84,59 @@ def draw_grading_page(canvas: Canvas, name: str, email: str, group: str, week: s
         )
 
 
-def add_grading_page(
-    student_file: Path, name: str, email: str, group: str, week: str, image: Path | None, output: Path | None = None
+def _write_grading_page(
+    pdf_file: PdfWriter, name: str, email: str, group: str, week: str, image: Path | None, output: Path
 ) -> None:
-    pdf_file = PdfWriter(clone_from=student_file)
     pdf_file.add_metadata({"/GroupName": group})
 
-    with BytesIO() as bytes_io:
-        canvas = Canvas(bytes_io, pagesize=A4)
-        draw_grading_page(canvas, name, email, group, week, image)
+    with SpooledTemporaryFile(spool_size, suffix=".pdf") as page_file:
+        canvas = Canvas(page_file, pagesize=A4)
+        draw_grading_page(canvas, name, email, group, week, load_image(image) if image else None)
         canvas.save()
-        bytes_io.seek(0)
-        pdf_file.merge(0, fileobj=bytes_io)
+        page_file.seek(0)
+        pdf_file.merge(0, fileobj=page_file)
+
+    pdf_file.write(output)
+
 
-    pdf_file.write(output or student_file)
+def add_grading_page(
+    student_file: Path, name: str, email: str, group: str, week: str, image: Path | None, output: Path | None = None
+) -> None:
+    output = output or student_file
+    data = student_file.read_bytes()
+    try:
+        reader = PdfReader(BytesIO(data), strict=True)
+        page_count = len(reader.pages)
+        pdf_file = PdfWriter(reader, incremental=True)
+    except PdfReadError:
+        # appending to a damaged file would carry its broken xref along, a full rewrite repairs it
+        pass
+    else:
+        # the appended xref stream needs PDF 1.5
+        if _pdf_version(pdf_file) < "1.5":
+            pdf_file.root_object[NameObject("/Version")] = NameObject("/1.5")
+        _write_grading_page(pdf_file, name, email, group, week, image, output)
+        # pypdf misreads some appends to files it already appended to, only keep the ones it reads back intact
+        if len(PdfReader(output).pages) == page_count + 1:
+            return
+    _write_grading_page(PdfWriter(clone_from=BytesIO(data)), name, email, group, week, image, output)
+
+
+def _get_field_value(file: PdfReader, name: str) -> str | None:
+    # the grading page is always page 0, older grading fields may remain further back in the document
+    for annotation in file.pages[0].get("/Annots", ()):
+        field = annotation.get_object()
+        while "/T" not in field and "/Parent" in field:
+            field = field["/Parent"].get_object()
+        if field.get("/T") == name:
+            value = field.get("/V")
+            return None if value is None else str(value)
+    return file.get_form_text_fields().get(name)
 
 
 def get_metadata(student_file: Path) -> tuple[float | None, str | None]:
-    file = PdfReader(student_file)
-    points = file.get_form_text_fields().get("moodleGradeField")
+    file = _read_pdf(student_file)
+    points = _get_field_value(file, "moodleGradeField")
     assert file.metadata
     name = file.metadata.get("/GroupName")
     if points is not None:
@@ -89,17 +148,18 @@ def get_metadata(student_file: Path) -> tuple[float | None, str | None]:
 
 
 def modify_pdf(student_file: Path, points: float | None = None, bonus_image: Path | None = None) -> None:
-    modified = False
-    pdf = PdfWriter(clone_from=student_file)
+    reader = _read_pdf(student_file)
+    add_bonus = bonus_image is not None and len(reader.pages[0].images) < 2
+    if not points and not add_bonus:
+        return
+    pdf = PdfWriter(clone_from=reader)
     if points:
         pdf.update_page_form_field_values(pdf.pages[0], {"moodleGradeField": str(points)}, auto_regenerate=False)
-        modified = True
-    page = pdf.get_page(0)
-    if bonus_image and len(page.images) < 2:
-        with BytesIO() as bytes_io:
-            canvas = Canvas(bytes_io, pagesize=A4)
+    if add_bonus:
+        with SpooledTemporaryFile(spool_size, suffix=".pdf") as page_file:
+            canvas = Canvas(page_file, pagesize=A4)
             canvas.drawImage(
-                bonus_image,
+                load_image(bonus_image),
                 x=0.5 * cm,
                 y=0.5 * cm,
                 width=20 * cm,
@@ -108,9 +168,7 @@ def modify_pdf(student_file: Path, points: float | None = None, bonus_image: Pat
                 anchor="n",
             )
             canvas.save()
-            bytes_io.seek(0)
-            new_reader = PdfReader(bytes_io)
-            page.merge_page(new_reader.get_page(0))
-        modified = True
-    if modified:
-        pdf.write(student_file)
+            page_file.seek(0)
+            new_reader = PdfReader(page_file)
+            pdf.get_page(0).merge_page(new_reader.get_page(0))
+    pdf.write(student_file)
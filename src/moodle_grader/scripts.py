@@ -1,14 +1,21 @@
 """Autograder scripts."""
 
+import os
+import shutil
+import tomllib
+from collections import deque
 from collections.abc import Iterable
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import cache, lru_cache
+from pathlib import Path, PurePosixPath
 from random import choice
+from stat import S_ISDIR, S_ISREG
 from typing import Annotated, ClassVar, Self
 from urllib.parse import parse_qs, urlparse, urlunsplit
-from urllib.request import urlretrieve
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo
 
 import tomlkit
+from email_validator import EmailNotValidError, validate_email
 from pydantic import BaseModel, EmailStr
 from rich.console import Console
 from rich.progress import BarColumn, MofNCompleteColumn, Progress, TextColumn, TimeRemainingColumn
@@ -21,6 +28,7 @@ from moodle_grader.pdf import add_grading_page, get_metadata, modify_pdf
 
 APP_NAME = "moodle_pdf_autograder"
 COURSE_CONFIG_NAME = "moodle_grader.toml"
+COPY_BUFSIZE = 1 << 18
 theme = Theme({
     "success": "green",
     "warning": "orange3",
@@ -33,22 +41,15 @@ console = Console(theme=theme)
 app = Typer(pretty_exceptions_show_locals=True)
 
 
-def track[T](sequence: Iterable[T], description: str, *, transient: bool = False) -> Iterable[T]:
-    progress = Progress(
+def make_progress() -> Progress:
+    return Progress(
         TextColumn("[progress.description]{task.description}"),
         BarColumn(),
         MofNCompleteColumn(),
         TimeRemainingColumn(elapsed_when_finished=True),
         console=console,
-        transient=transient,
     )
 
-    with progress:
-        yield from progress.track(
-            sequence,
-            description=description,
-        )
-
 
 class AppConfig(BaseModel):
     name: str
@@ -61,13 +62,26 @@ class AppConfig(BaseModel):
     def get(cls) -> Self:
         path = cls.location
         if path.is_file():
-            return cls.model_validate_json(path.read_text())
+            return cls._load(path.stat().st_mtime_ns)
         else:
             raise Abort
 
+    @classmethod
+    @lru_cache(maxsize=1)
+    def _load(cls, mtime_ns: int) -> Self:
+        return cls.model_validate_json(cls.location.read_bytes())
+
     def save(self) -> None:
         self.location.parent.mkdir(parents=True, exist_ok=True)
-        self.location.write_text(self.model_dump_json(indent=2))
+        self.location.write_bytes(self.model_dump_json(indent=2).encode())
+
+
+@cache
+def _find_course_config(folder: Path) -> Path | None:
+    for parent in (folder, *folder.parents):
+        if (path := parent.joinpath(COURSE_CONFIG_NAME)).exists():
+            return path
+    return None
 
 
 class CourseConfig(BaseModel):
@@ -78,29 +92,30 @@ class CourseConfig(BaseModel):
 
     @classmethod
     def get(cls) -> Self:
-        path = Path().absolute()
-        while not path.joinpath(COURSE_CONFIG_NAME).exists():
-            if path == path.parent:
-                console.print(
-                    "[error]Could not find course config file in any parent folder.[/]\n"
-                    "Please run the 'init' command in the course folder you want to use."
-                )
-                raise Abort
-            path = path.parent
-        data = tomlkit.loads(path.joinpath(COURSE_CONFIG_NAME).read_text())
-        return cls.model_validate(data)
+        path = _find_course_config(Path().absolute())
+        if path is None:
+            console.print(
+                "[error]Could not find course config file in any parent folder.[/]\n"
+                "Please run the 'init' command in the course folder you want to use."
+            )
+            raise Abort
+        return cls._load(path, path.stat().st_mtime_ns)
+
+    @classmethod
+    @lru_cache(maxsize=1)
+    def _load(cls, path: Path, mtime_ns: int) -> Self:
+        with path.open("rb") as file:
+            return cls.model_validate(tomllib.load(file))
 
     def save(self, path: Path) -> None:
         path.write_text(tomlkit.dumps(self.model_dump()))
 
 
 def rmtree(path: Path) -> None:
-    if path.is_file():
-        path.unlink()
+    if path.is_dir(follow_symlinks=False):
+        shutil.rmtree(path)
     else:
-        for child in path.iterdir():
-            rmtree(child)
-        path.rmdir()
+        path.unlink()
 
 
 @app.command(help="Opens the config file.")
@@ -117,17 +132,20 @@ def config():
 
 @app.command()
 def init():
-    app_config = AppConfig.get()
-    if not app_config:
+    if not AppConfig.location.is_file():
         name = Prompt.ask("What name do you want to use?", console=console)
         email = Prompt.ask(
             "What email address do you want to use?",
             default=f"{'.'.join(name.lower().split())}@rwth-aachen.de",
             console=console,
         )
+        try:
+            email = validate_email(email, check_deliverability=False).normalized
+        except EmailNotValidError as error:
+            console.print(f"[error]The email address you entered is not valid: {error}")
+            raise Abort from error
         moodle_token = Prompt.ask("Please enter a moodle API token.")
-        app_config = AppConfig(name=name, email=email, moodle_token=moodle_token)
-        app_config.save()
+        AppConfig(name=name, email=email, moodle_token=moodle_token).save()
 
     full_url = urlparse(Prompt.ask("Please enter the URL to moodle page of the course you want to work with"))
     base_url = urlunsplit((full_url.scheme, full_url.netloc, "", "", ""))
@@ -150,29 +168,109 @@ def init():
     course_config.save(Path(COURSE_CONFIG_NAME))
 
 
-def _write_file(token: str, url: str, target: Path) -> None:
-    suffix = url.split(".")[-1]
-    urlretrieve(f"{url}?token={token}", target.with_suffix(f".{suffix}"))
+def _url_path(url: str) -> PurePosixPath:
+    return PurePosixPath(urlparse(url).path)
+
+
+def _write_file(moodle: MoodleConnection, url: str, target: Path) -> None:
+    moodle.download_file(url, target.with_suffix(_url_path(url).suffix))
+
+
+def _group_downloads(folder: Path, urls: list[str]) -> list[tuple[str, Path]]:
+    # files from different folders of one submission can share a name, give each its own target
+    downloads: list[tuple[str, Path]] = []
+    names: set[str] = set()
+    for url in urls:
+        path = _url_path(url)
+        name, i = path.name, 1
+        while name in names:
+            name = f"{path.stem}_{i}{path.suffix}"
+            i += 1
+        names.add(name)
+        downloads.append((url, folder.joinpath(name)))
+    return downloads
+
+
+def _is_hidden(name: str) -> bool:
+    return name.startswith(".") or name == "__MACOSX"
 
 
 def find_pdf(path: Path) -> Path | None:
-    if path.is_file() and path.suffix == ".pdf":
-        return path
-    elif path.is_dir() and not path.name.startswith(".") and path.name != "__MACOSX":
-        for child in path.iterdir():
-            if found := find_pdf(child):
-                return found
+    try:
+        mode = path.stat().st_mode
+    except FileNotFoundError:
+        return None
+    if S_ISREG(mode):
+        return path if path.suffix == ".pdf" else None
+    if not S_ISDIR(mode) or _is_hidden(path.name):
+        return None
+    queue = deque([os.fspath(path)])
+    while queue:
+        with os.scandir(queue.popleft()) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    if entry.name.endswith(".pdf"):
+                        return Path(entry.path)
+                elif entry.is_dir() and not _is_hidden(entry.name):
+                    queue.append(entry.path)
+    return None
+
+
+@lru_cache(maxsize=8)
+def _load_images(path: Path, mtime_ns: int) -> tuple[Path, ...]:
+    return tuple(path.iterdir())
 
 
 def select_image(path: Path | None) -> Iterable[Path | None]:
     if path is None or path.is_file():
         while True:
             yield path
-    images = list(path.iterdir())
+    images = _load_images(path, path.stat().st_mtime_ns)
     while True:
         yield choice(images)
 
 
+def _is_pdf_member(info: ZipInfo) -> bool:
+    *folders, name = info.filename.split("/")
+    return not info.is_dir() and name.endswith(".pdf") and not any(_is_hidden(folder) for folder in folders)
+
+
+def _unzip(path: Path) -> tuple[Path, Path | None]:
+    pdf_path = None
+    with path.open("rb", buffering=COPY_BUFSIZE) as archive, ZipFile(archive) as unzipped_path:
+        members = unzipped_path.infolist()
+        single = members[0] if len(members) == 1 and not members[0].is_dir() else None
+        # a lone member with the archive's own suffix would overwrite the archive while it is being read
+        if single is not None and Path(single.orig_filename).suffix.lower() != path.suffix.lower():
+            new_path = path.with_suffix(Path(single.orig_filename).suffix)
+            with unzipped_path.open(single) as source, new_path.open("wb") as target:
+                shutil.copyfileobj(source, target, COPY_BUFSIZE)
+            if _is_pdf_member(single):
+                pdf_path = new_path
+        else:
+            new_path = path.with_suffix("")
+            pdf_member = min(filter(_is_pdf_member, members), key=lambda info: info.filename.count("/"), default=None)
+            for info in members:
+                extracted = Path(unzipped_path.extract(info, new_path))
+                if info is pdf_member:
+                    pdf_path = extracted
+    path.unlink()
+    return new_path, pdf_path
+
+
+def _format_submission(path: Path, name: str, email: str, assignment: str, image: Path | None) -> None:
+    if path.suffix == ".zip":
+        path, pdf_path = _unzip(path)
+    else:
+        pdf_path = find_pdf(path)
+    if not pdf_path:
+        return
+    if pdf_path != path:
+        pdf_path.rename(pdf_path := path.with_suffix(".pdf"))
+
+    add_grading_page(pdf_path, name, email, path.stem, assignment, image)
+
+
 @app.command()
 def download(
     assignment_week: Annotated[
@@ -217,45 +315,43 @@ def download(
     moodle = MoodleConnection.from_configs(app, course)
     with console.status("Getting assignment info"):
         files = moodle.get_submission_files(assignment, course.tutorials)
-    for name, urls in track(files.items(), "Downloading submissions"):
+    downloads: list[tuple[str, Path]] = []
+    for name, urls in files.items():
         if len(urls) == 1:
-            _write_file(app.moodle_token, urls[0], output.joinpath(name))
+            downloads.append((urls[0], output.joinpath(name)))
         else:
             group_folder = output.joinpath(name)
             group_folder.mkdir()
-            for url in urls:
-                file_name = url.split("/")[-1]
-                _write_file(app.moodle_token, url, group_folder.joinpath(file_name))
-
-    for path, image in zip(
-        track(list(output.iterdir()), "Formatting submissions"), select_image(insert_image), strict=False
-    ):
-        if path.suffix == ".zip":
-            with ZipFile(path) as unzipped_path:
-                if len(unzipped_path.filelist) == 1:
-                    inner_file = unzipped_path.filelist[0]
-                    new_path = path.with_suffix(Path(inner_file.orig_filename).suffix)
-                    unzipped_path.extract(inner_file, new_path)
-                else:
-                    new_path = path.with_suffix("")
-                    unzipped_path.extractall(new_path)
-            path.unlink()
-            path = new_path
-
-        pdf_path = find_pdf(path)
-        if not pdf_path:
-            continue
-        if pdf_path != path:
-            pdf_path.rename(pdf_path := path.with_suffix(".pdf"))
-
-        add_grading_page(
-            pdf_path,
-            app.name,
-            app.email,
-            path.stem,
-            assignment,
-            image,
-        )
+            downloads.extend(_group_downloads(group_folder, urls))
+    with make_progress() as progress:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(_write_file, moodle, url, target) for url, target in downloads]
+            for future in progress.track(
+                as_completed(futures), total=len(futures), description="Downloading submissions"
+            ):
+                future.result()
+
+        paths = list(output.iterdir())
+        with ProcessPoolExecutor() as executor:
+            futures = [
+                executor.submit(_format_submission, path, app.name, app.email, assignment, image)
+                for path, image in zip(paths, select_image(insert_image), strict=False)
+            ]
+            for future in progress.track(
+                as_completed(futures), total=len(futures), description="Formatting submissions"
+            ):
+                future.result()
+
+
+def _finalize_submission(file: Path, image: Path | None, bonus_points: float) -> tuple[float, str]:
+    points, name = get_metadata(file)
+    if points is None:
+        points = 0.0
+    if name is None:
+        name = file.stem
+    if points >= bonus_points and image is not None:
+        modify_pdf(file, bonus_image=image)
+    return points, name
 
 
 @app.command()
@@ -293,24 +389,34 @@ def upload(
     app = AppConfig.get()
     course = CourseConfig.get()
     moodle = MoodleConnection.from_configs(app, course)
-    group_names = [path.stem for path in data.iterdir() if path.suffix == ".pdf"]
+    with os.scandir(data) as entries:
+        pdf_paths = [Path(entry.path) for entry in entries if entry.name.endswith(".pdf") and entry.is_file()]
     with console.status("Getting assignment info"):
-        assignment_id, users = moodle.get_grading_data(assignment, group_names)
+        assignment_id, users = moodle.get_grading_data(assignment, [path.stem for path in pdf_paths])
     files: dict[Path, tuple[float, str]] = {}
-    pdf_paths = [path for path in data.iterdir() if path.suffix == ".pdf"]
-    for file, image in zip(track(pdf_paths, "Finalizing files"), select_image(insert_image), strict=False):
-        points, name = get_metadata(file)
-        if points is None:
-            points = 0.0
-        if name is None:
-            name = file.stem
-        files[file] = (points, name)
-        if points >= course.max_points / 2 and image is not None:
-            modify_pdf(file, bonus_image=image)
-
-    for file in track(pdf_paths, "Uploading files"):
-        points, name = files[file]
-        moodle.upload_graded_assignment(assignment_id, users[name], file, points)
+    graded: list[tuple[list[int], int, float]] = []
+    bonus_points = course.max_points / 2
+    with make_progress() as progress:
+        with ProcessPoolExecutor() as executor:
+            futures = {
+                executor.submit(_finalize_submission, file, image, bonus_points): file
+                for file, image in zip(pdf_paths, select_image(insert_image), strict=False)
+            }
+            for future in progress.track(as_completed(futures), total=len(futures), description="Finalizing files"):
+                files[futures[future]] = future.result()
+
+        if missing := sorted({name for _, name in files.values()} - users.keys()):
+            console.print(f"[error]No Moodle users found for {', '.join(missing)}, nothing was uploaded")
+            raise Abort
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = {executor.submit(moodle.upload_files, [file]): file for file in pdf_paths}
+            for future in progress.track(as_completed(futures), total=len(futures), description="Uploading files"):
+                points, name = files[futures[future]]
+                graded.append((users[name], future.result()[0]["itemid"], points))
+
+    with console.status("Saving grades"):
+        moodle.save_grades(assignment_id, graded)
 
 
 if __name__ == "__main__":